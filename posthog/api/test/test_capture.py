@@ -1144,7 +1144,7 @@ class TestCapture(BaseTest):
         decompressed_data = gzip.decompress(
             base64.b64decode(data_sent_to_kafka["properties"]["$snapshot_data"]["data"])
         ).decode("utf-16", "surrogatepass")
-        data_sent_to_kafka["properties"]["$snapshot_data"]["data"] = decompressed_data
+        data_sent_to_kafka["properties"]["$snapshot_data"]["data"] = json.loads(decompressed_data)
 
         self.assertEqual(
             data_sent_to_kafka,
@@ -1155,15 +1155,13 @@ class TestCapture(BaseTest):
                         "chunk_id": "fake-uuid",
                         "chunk_index": 0,
                         "chunk_count": 1,
-                        "data": json.dumps(
-                            [
-                                {
-                                    "type": snapshot_type,
-                                    "data": {"source": snapshot_source, "data": event_data},
-                                    "timestamp": timestamp,
-                                }
-                            ]
-                        ),
+                        "data": [
+                            {
+                                "type": snapshot_type,
+                                "data": {"source": snapshot_source, "data": event_data},
+                                "timestamp": timestamp,
+                            }
+                        ],
                         "events_summary": [
                             {
                                 "type": snapshot_type,
@@ -1,5 +1,6 @@
 # This file contains all CREATE TABLE queries, used to sync and test schema
 import re
+from typing import Callable, Dict, Union
 
 from posthog.clickhouse.dead_letter_queue import *
 from posthog.clickhouse.plugin_log_entries import *
@@ -83,4 +84,20 @@ CREATE_TABLE_QUERIES = (
 )
 
 build_query = lambda query: query if isinstance(query, str) else query()
-get_table_name = lambda query: re.findall(r" ([a-z0-9_]+) ON CLUSTER", build_query(query))[0]
+
+_TABLE_NAME_RE = re.compile(r" ([a-z0-9_]+) ON CLUSTER")
+# Names of CREATE_TABLE_QUERIES tables, filled in as they are first looked up
+_TABLE_NAME_CACHE: Dict[Union[str, Callable[[], str]], str] = {}
+
+
+def get_table_name(query: Union[str, Callable[[], str]]) -> str:
+    if query in _TABLE_NAME_CACHE:
+        return _TABLE_NAME_CACHE[query]
+
+    match = _TABLE_NAME_RE.search(build_query(query))
+    if match is None:
+        raise ValueError(f"Could not find a table name in query: {build_query(query)}")
+    table_name = match.group(1)
+    if query in CREATE_TABLE_QUERIES:
+        _TABLE_NAME_CACHE[query] = table_name
+    return table_name
@@ -2,25 +2,38 @@ import base64
 import dataclasses
 import gzip
 import json
+import zlib
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from operator import itemgetter
 from typing import (
     Any,
     DefaultDict,
     Dict,
     Generator,
+    Iterable,
     List,
     Optional,
+    Tuple,
     TypedDict,
     Union,
+    cast,
 )
 
-from sentry_sdk.api import capture_exception, capture_message
+import numpy as np
+import orjson
+from django.conf import settings
+from sentry_sdk.api import capture_message
 
 from posthog.models import utils
 
 FULL_SNAPSHOT = 2
 
+# Values of `$snapshot_data.compression` on chunked snapshots. Older chunks were encoded as UTF-16 before compressing
+COMPRESSION_GZIP_BASE64_UTF16 = "gzip-base64"
+COMPRESSION_GZIP_BASE64_UTF8 = "gzip-base64-utf8"
+
 Event = Dict[str, Any]
 SnapshotData = Dict
 WindowId = Optional[str]
@@ -89,6 +102,14 @@ EVENT_SUMMARY_DATA_INCLUSIONS = [
     "payload.level",
 ]
 
+# Lookup sets derived from EVENT_SUMMARY_DATA_INCLUSIONS, split by where the key lives on the event
+_SUMMARY_DATA_KEYS = frozenset(key for key in EVENT_SUMMARY_DATA_INCLUSIONS if not key.startswith("payload."))
+_SUMMARY_PAYLOAD_KEYS = frozenset(
+    key[len("payload.") :] for key in EVENT_SUMMARY_DATA_INCLUSIONS if key.startswith("payload.")
+)
+# Exact types rather than isinstance, so that bools (an int subclass) are left out
+_SUMMARY_VALUE_TYPES = frozenset((str, int))
+
 
 class RecordingSegment(TypedDict):
     start_time: datetime
@@ -132,46 +153,56 @@ class DecompressedRecordingData(TypedDict):
 
 def preprocess_session_recording_events_for_clickhouse(events: List[Event]) -> List[Event]:
     result = []
-    snapshots_by_session_and_window_id = defaultdict(list)
+    snapshots_by_session_and_window_id: DefaultDict[Tuple[str, WindowId], List[Event]] = defaultdict(list)
     for event in events:
         if is_unchunked_snapshot(event):
-            session_id = event["properties"]["$session_id"]
-            window_id = event["properties"].get("$window_id")
-            snapshots_by_session_and_window_id[(session_id, window_id)].append(event)
+            properties = event["properties"]
+            snapshots_by_session_and_window_id[(properties["$session_id"], properties.get("$window_id"))].append(event)
         else:
             result.append(event)
 
-    for _, snapshots in snapshots_by_session_and_window_id.items():
-        result.extend(list(compress_and_chunk_snapshots(snapshots)))
+    for snapshots in snapshots_by_session_and_window_id.values():
+        result.extend(compress_and_chunk_snapshots(snapshots))
 
     return result
 
 
 def compress_and_chunk_snapshots(events: List[Event], chunk_size=512 * 1024) -> Generator[Event, None, None]:
-    data_list = [event["properties"]["$snapshot_data"] for event in events]
+    data_list = []
+    has_full_snapshot = False
+    for event in events:
+        snapshot_data = event["properties"]["$snapshot_data"]
+        data_list.append(snapshot_data)
+        if not has_full_snapshot and snapshot_data.get("type") == RRWEB_MAP_EVENT_TYPE.FullSnapshot:
+            has_full_snapshot = True
+
     session_id = events[0]["properties"]["$session_id"]
-    has_full_snapshot = any(snapshot_data["type"] == RRWEB_MAP_EVENT_TYPE.FullSnapshot for snapshot_data in data_list)
     window_id = events[0]["properties"].get("$window_id")
 
-    compressed_data = compress_to_string(json.dumps(data_list))
+    compression = (
+        COMPRESSION_GZIP_BASE64_UTF8
+        if settings.SESSION_RECORDING_UTF8_COMPRESSION_ENABLED
+        else COMPRESSION_GZIP_BASE64_UTF16
+    )
+    compressed_data = compress_to_string(_json_dumps(data_list), compression)
 
     id = str(utils.UUIDT())
-    chunks = chunk_string(compressed_data, chunk_size)
+    chunk_count = -(-len(compressed_data) // chunk_size)
+    # Shared by every chunk, only $snapshot_data differs between them
+    base_properties = {**events[0]["properties"], "$session_id": session_id, "$window_id": window_id}
 
-    for index, chunk in enumerate(chunks):
+    for index, chunk in enumerate(chunk_string(compressed_data, chunk_size)):
         yield {
             **events[0],
             "properties": {
-                **events[0]["properties"],
-                "$session_id": session_id,
-                "$window_id": window_id,
+                **base_properties,
                 # If it is the first chunk we include all events
                 "$snapshot_data": {
                     "chunk_id": id,
                     "chunk_index": index,
-                    "chunk_count": len(chunks),
-                    "data": chunk,
-                    "compression": "gzip-base64",
+                    "chunk_count": chunk_count,
+                    "data": str(chunk, "utf-8"),
+                    "compression": compression,
                     "has_full_snapshot": has_full_snapshot,
                     # We only store this field on the first chunk as it contains all events, not just this chunk
                     "events_summary": get_events_summary_from_snapshot_data(data_list) if index == 0 else None,
@@ -180,31 +211,78 @@ def compress_and_chunk_snapshots(events: List[Event], chunk_size=512 * 1024) ->
         }
 
 
-def chunk_string(string: str, chunk_length: int) -> List[str]:
-    """Split a string into chunk_length-sized elements. Reversal operation: `''.join()`."""
-    return [string[0 + offset : chunk_length + offset] for offset in range(0, len(string), chunk_length)]
+def chunk_string(buffer: bytes, chunk_length: int) -> Generator[memoryview, None, None]:
+    """Lazily split a buffer into chunk_length-sized views without copying. Reversal operation: `b''.join()`."""
+    view = memoryview(buffer)
+    for offset in range(0, len(buffer), chunk_length):
+        yield view[offset : offset + chunk_length]
 
 
 def is_unchunked_snapshot(event: Dict) -> bool:
-    try:
-        is_snapshot = event["event"] == "$snapshot"
-    except KeyError:
+    if "event" not in event:
         raise ValueError('All events must have the event name field "event"!')
-    try:
-        return is_snapshot and "chunk_id" not in event["properties"]["$snapshot_data"]
-    except KeyError:
-        capture_exception()
+    if event["event"] != "$snapshot":
+        return False
+
+    snapshot_data = event.get("properties", {}).get("$snapshot_data")
+    if snapshot_data is None:
         raise ValueError('$snapshot events must contain property "$snapshot_data"!')
+    return "chunk_id" not in snapshot_data
 
 
-def compress_to_string(json_string: str) -> str:
-    compressed_data = gzip.compress(json_string.encode("utf-16", "surrogatepass"))
-    return base64.b64encode(compressed_data).decode("utf-8")
+def compress_to_string(json_bytes: bytes, compression: str = COMPRESSION_GZIP_BASE64_UTF8) -> bytes:
+    """Compresses UTF-8 encoded JSON, only transcoding it when writing the legacy UTF-16 format"""
+    if compression == COMPRESSION_GZIP_BASE64_UTF16:
+        json_bytes = json_bytes.decode("utf-8").encode("utf-16")
+    # Fastest gzip level - the recording is compressed inline during ingestion so speed matters more than ratio
+    compressed_data = gzip.compress(json_bytes, compresslevel=1)
+    # Left as bytes so chunking can slice it without copying, chunks are decoded when they are emitted
+    return base64.b64encode(compressed_data)
 
 
-def decompress(base64data: str) -> str:
-    compressed_bytes = base64.b64decode(base64data)
-    return gzip.decompress(compressed_bytes).decode("utf-16", "surrogatepass")
+def decompress(base64_chunks: Iterable[str], compression: str = COMPRESSION_GZIP_BASE64_UTF8) -> Union[bytearray, str]:
+    """
+    Streams the base64 chunks through the gzip decompressor one at a time, so the joined base64 string and
+    compressed bytes of the whole recording are never held in memory. UTF-8 payloads are returned undecoded.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # Expect a gzip header
+    decompressed = bytearray()
+    remainder = ""
+    for chunk in base64_chunks:
+        # Chunks can be split at any length, so carry over whatever doesn't fill a 4 character base64 group
+        chunk = remainder + chunk
+        aligned_length = len(chunk) - len(chunk) % 4
+        remainder = chunk[aligned_length:]
+        decompressed += decompressor.decompress(base64.b64decode(chunk[:aligned_length]))
+    decompressed += decompressor.decompress(base64.b64decode(remainder))
+    decompressed += decompressor.flush()
+    if not decompressor.eof:
+        # gzip.decompress raises on truncated input, the streaming decompressor just returns what it has so far
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+    if compression == COMPRESSION_GZIP_BASE64_UTF16:
+        return decompressed.decode("utf-16", "surrogatepass")
+    return decompressed
+
+
+def _json_dumps(data: Any) -> bytes:
+    """
+    UTF-8 encoded JSON. NaN and Infinity are written as null, the same as the browser's JSON.stringify does,
+    so they can only appear here if a client hand-crafted its payload
+    """
+    try:
+        return orjson.dumps(data)
+    except orjson.JSONEncodeError:
+        # orjson rejects some values the stdlib accepts, e.g. lone surrogates sent by clients, which json escapes
+        return json.dumps(data).encode("utf-8")
+
+
+def _json_loads(data: Union[bytes, bytearray, str]) -> Any:
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # Payloads written by json.dumps may contain escaped lone surrogates, which orjson refuses to parse
+        return json.loads(data)
 
 
 def decompress_chunked_snapshot_data(
@@ -236,22 +314,19 @@ def decompress_chunked_snapshot_data(
     if "chunk_id" not in all_recording_events[0]["snapshot_data"]:
         paginated_list = paginate_list(all_recording_events, limit, offset)
         for event in paginated_list.paginated_list:
-            snapshot_data_by_window_id[event["window_id"]].append(
-                get_events_summary_from_snapshot_data([event["snapshot_data"]])[0]
-                if return_only_activity_data
-                else event["snapshot_data"]
-            )
+            if not return_only_activity_data:
+                snapshot_data_by_window_id[event["window_id"]].append(event["snapshot_data"])
+                continue
+
+            event_summary = get_event_summary(event["snapshot_data"])
+            if event_summary is not None:
+                snapshot_data_by_window_id[event["window_id"]].append(event_summary)
         return DecompressedRecordingData(
             has_next=paginated_list.has_next, snapshot_data_by_window_id=snapshot_data_by_window_id
         )
 
-    # Split decompressed recording events into their chunks
-    chunks_collector: DefaultDict[str, List[SnapshotDataTaggedWithWindowId]] = defaultdict(list)
-    for event in all_recording_events:
-        chunks_collector[event["snapshot_data"]["chunk_id"]].append(event)
-
     # Paginate the list of chunks
-    paginated_chunk_list = paginate_list(list(chunks_collector.values()), limit, offset)
+    paginated_chunk_list = paginate_list(_group_chunks_by_chunk_id(all_recording_events), limit, offset)
 
     has_next = paginated_chunk_list.has_next
     chunk_list: List[List[SnapshotDataTaggedWithWindowId]] = paginated_chunk_list.paginated_list
@@ -270,10 +345,21 @@ def decompress_chunked_snapshot_data(
             )
             continue
 
-        b64_compressed_data = "".join(
-            chunk["snapshot_data"]["data"] for chunk in sorted(chunks, key=lambda c: c["snapshot_data"]["chunk_index"])
-        )
-        decompressed_data = json.loads(decompress(b64_compressed_data))
+        # Chunk indexes are a dense 0..chunk_count-1 range, so each chunk can be slotted straight into place
+        chunk_data: List[Optional[str]] = [None] * len(chunks)
+        for chunk in chunks:
+            chunk_data[chunk["snapshot_data"]["chunk_index"]] = chunk["snapshot_data"]["data"]
+
+        if None in chunk_data:
+            capture_message(
+                "Found duplicate session recording chunks! Team: {}, Session: {}, Chunk-id: {}".format(
+                    team_id, session_recording_id, chunks[0]["snapshot_data"]["chunk_id"]
+                )
+            )
+            continue
+
+        compression = chunks[0]["snapshot_data"].get("compression", COMPRESSION_GZIP_BASE64_UTF16)
+        decompressed_data = _json_loads(decompress(cast(List[str], chunk_data), compression))
 
         # Decompressed data can be large, and in metadata calculations, we only care if the event is "active"
         # This pares down the data returned, so we're not passing around a massive object
@@ -285,11 +371,9 @@ def decompress_chunked_snapshot_data(
     return DecompressedRecordingData(has_next=has_next, snapshot_data_by_window_id=snapshot_data_by_window_id)
 
 
-def is_active_event(event: SessionRecordingEventSummary) -> bool:
-    """
-    Determines which rr-web events are "active" - meaning user generated
-    """
-    active_rr_web_sources = [
+# event.data.source values of incremental snapshots which are user generated
+ACTIVE_RR_WEB_SOURCES = frozenset(
+    {
         1,  # MouseMove,
         2,  # MouseInteraction,
         3,  # Scroll,
@@ -298,8 +382,15 @@ def is_active_event(event: SessionRecordingEventSummary) -> bool:
         6,  # TouchMove,
         7,  # MediaInteraction,
         12,  # Drag,
-    ]
-    return event["type"] == 3 and event["data"].get("source") in active_rr_web_sources
+    }
+)
+
+
+def is_active_event(event: SessionRecordingEventSummary) -> bool:
+    """
+    Determines which rr-web events are "active" - meaning user generated
+    """
+    return event["type"] == 3 and event["data"].get("source") in ACTIVE_RR_WEB_SOURCES
 
 
 def parse_snapshot_timestamp(timestamp: int):
@@ -319,33 +410,40 @@ def get_active_segments_from_event_list(
     the segments of the recording where the user is "active". And active segment ends
     when there isn't another active event for activity_threshold_seconds seconds
     """
-    active_event_timestamps = [event["timestamp"] for event in event_list if is_active_event(event)]
-
-    active_recording_segments: List[RecordingSegment] = []
-    current_active_segment: Optional[RecordingSegment] = None
-    for current_timestamp_int in active_event_timestamps:
-        current_timestamp = parse_snapshot_timestamp(current_timestamp_int)
-        # If the time since the last active event is less than the threshold, continue the existing segment
-        if current_active_segment and (current_timestamp - current_active_segment["end_time"]) <= timedelta(
-            seconds=activity_threshold_seconds
-        ):
-            current_active_segment["end_time"] = current_timestamp
+    # Single pass over the events, everything after works on the array of active timestamps
+    active_event_timestamps = np.fromiter(
+        (event["timestamp"] for event in event_list if is_active_event(event)), dtype=np.float64
+    )
+    segment_starts, segment_ends = _get_active_segment_bounds(
+        active_event_timestamps, activity_threshold_seconds * 1000
+    )
 
-        # Otherwise, start a new segment
-        else:
-            if current_active_segment:
-                active_recording_segments.append(current_active_segment)
-            current_active_segment = RecordingSegment(
-                start_time=current_timestamp, end_time=current_timestamp, window_id=window_id, is_active=True
-            )
+    return [
+        RecordingSegment(
+            start_time=parse_snapshot_timestamp(start),
+            end_time=parse_snapshot_timestamp(end),
+            window_id=window_id,
+            is_active=True,
+        )
+        for start, end in zip(segment_starts.tolist(), segment_ends.tolist())
+    ]
 
-    # Add the active last segment if it hasn't already been added
-    if current_active_segment and (
-        len(active_recording_segments) == 0 or active_recording_segments[-1] != current_active_segment
-    ):
-        active_recording_segments.append(current_active_segment)
 
-    return active_recording_segments
+def _get_active_segment_bounds(
+    active_event_timestamps: np.ndarray, activity_threshold_ms: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the first and last timestamp of each run of active events no more than activity_threshold_ms apart.
+    Works on whole arrays only, so the cost doesn't involve any interpreter work per event.
+    """
+    if len(active_event_timestamps) == 0:
+        return active_event_timestamps, active_event_timestamps
+
+    # A new segment starts wherever the gap to the previous active event exceeds the threshold
+    segment_breaks = np.flatnonzero(np.diff(active_event_timestamps) > activity_threshold_ms)
+    segment_starts = active_event_timestamps[np.append(0, segment_breaks + 1)]
+    segment_ends = active_event_timestamps[np.append(segment_breaks, len(active_event_timestamps) - 1)]
+    return segment_starts, segment_ends
 
 
 def get_events_summary_from_snapshot_data(snapshot_data: List[SnapshotData]) -> List[SessionRecordingEventSummary]:
@@ -355,37 +453,57 @@ def get_events_summary_from_snapshot_data(snapshot_data: List[SnapshotData]) ->
     and in the inclusion list to keep the payload minimal
     """
     events_summary = []
-
     for event in snapshot_data:
-        if "timestamp" not in event or "type" not in event:
-            continue
+        event_summary = get_event_summary(event)
+        if event_summary is not None:
+            events_summary.append(event_summary)
+
+    # No guarantees are made about order so we sort here to be sure, skipping the sort if they already are in order
+    if not _is_sorted_by_timestamp(events_summary):
+        events_summary.sort(key=itemgetter("timestamp"))
+
+    return events_summary
+
 
-        # Get all top level data values
-        data = {
+def get_event_summary(event: SnapshotData) -> Optional[SessionRecordingEventSummary]:
+    """
+    Summary of a single snapshot data event, see `get_events_summary_from_snapshot_data`.
+    Returns None for malformed events missing a timestamp or type
+    """
+    if "timestamp" not in event or "type" not in event:
+        return None
+
+    event_data = event.get("data") or {}
+    # Get all top level data values
+    data: Dict[str, Any] = {
+        key: value
+        for key, value in event_data.items()
+        if key in _SUMMARY_DATA_KEYS and type(value) in _SUMMARY_VALUE_TYPES
+    }
+    # Some events have a payload, some values of which we want
+    payload = event_data.get("payload")
+    if payload:
+        data["payload"] = {
             key: value
-            for key, value in event.get("data", {}).items()
-            if type(value) in [str, int] and key in EVENT_SUMMARY_DATA_INCLUSIONS
+            for key, value in payload.items()
+            if key in _SUMMARY_PAYLOAD_KEYS and type(value) in _SUMMARY_VALUE_TYPES
         }
-        # Some events have a payload, some values of which we want
-        if event.get("data", {}).get("payload"):
-            data["payload"] = {
-                key: value
-                for key, value in event["data"]["payload"].items()
-                if type(value) in [str, int] and f"payload.{key}" in EVENT_SUMMARY_DATA_INCLUSIONS
-            }
-
-        events_summary.append(
-            SessionRecordingEventSummary(
-                timestamp=event["timestamp"],
-                type=event["type"],
-                data=data,
-            )
-        )
 
-    # No guarantees are made about order so we sort here to be sure
-    events_summary.sort(key=lambda x: x["timestamp"])
+    return SessionRecordingEventSummary(
+        timestamp=event["timestamp"],
+        type=event["type"],
+        data=data,
+    )
 
-    return events_summary
+
+def _is_sorted_by_timestamp(events_summary: List[SessionRecordingEventSummary]) -> bool:
+    previous_timestamp: Optional[int] = None
+    for event in events_summary:
+        timestamp = event["timestamp"]
+        if previous_timestamp is not None and timestamp < previous_timestamp:
+            return False
+        previous_timestamp = timestamp
+    return True
 
 
 def generate_inactive_segments_for_range(
@@ -440,14 +558,42 @@ def generate_inactive_segments_for_range(
     return inactive_segments
 
 
+def _get_chunk_id(event: SnapshotDataTaggedWithWindowId) -> str:
+    return event["snapshot_data"]["chunk_id"]
+
+
+def _group_chunks_by_chunk_id(
+    all_recording_events: List[SnapshotDataTaggedWithWindowId],
+) -> List[List[SnapshotDataTaggedWithWindowId]]:
+    """
+    Split recording events into their chunks, in order of first appearance. Events are queried ordered by timestamp
+    and all chunks of a batch share one, so chunks almost always arrive contiguously and can be grouped as runs.
+    If a chunk_id turns up in more than one run we fall back to collecting them by chunk_id.
+    """
+    chunk_runs = [list(run) for _, run in groupby(all_recording_events, key=_get_chunk_id)]
+    if len(chunk_runs) == len({_get_chunk_id(run[0]) for run in chunk_runs}):
+        return chunk_runs
+
+    chunks_collector: DefaultDict[str, List[SnapshotDataTaggedWithWindowId]] = defaultdict(list)
+    for event in all_recording_events:
+        chunks_collector[_get_chunk_id(event)].append(event)
+    return list(chunks_collector.values())
+
+
 @dataclasses.dataclass
 class PaginatedList:
+    # dataclass(slots=True) needs Python 3.10
+    __slots__ = ("has_next", "paginated_list")
+
     has_next: bool
     paginated_list: List
 
 
 def paginate_list(list_to_paginate: List, limit: Optional[int], offset: int) -> PaginatedList:
-    if not limit:
+    if not limit and offset == 0:
+        # Nothing to paginate, so hand back the list itself rather than a full copy of it
+        return PaginatedList(has_next=False, paginated_list=list_to_paginate)
+    elif not limit:
         has_next = False
         paginated_list = list_to_paginate[offset:]
     elif offset + limit < len(list_to_paginate):
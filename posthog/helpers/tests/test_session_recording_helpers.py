@@ -1,3 +1,6 @@
+import base64
+import gzip
+import json
 from datetime import datetime, timedelta, timezone
 from typing import cast
 
@@ -11,6 +14,7 @@ from posthog.helpers.session_recording import (
     SnapshotData,
     SnapshotDataTaggedWithWindowId,
     compress_and_chunk_snapshots,
+    decompress,
     decompress_chunked_snapshot_data,
     generate_inactive_segments_for_range,
     get_active_segments_from_event_list,
@@ -91,7 +95,8 @@ def test_preprocess_recording_event_creates_chunks_split_by_session_and_window_i
     assert preprocess_session_recording_events_for_clickhouse(preprocessed) == preprocessed
 
 
-def test_compression_and_chunking(raw_snapshot_events, mocker: MockerFixture):
+def test_compression_and_chunking(raw_snapshot_events, mocker: MockerFixture, settings):
+    settings.SESSION_RECORDING_UTF8_COMPRESSION_ENABLED = True
     mocker.patch("posthog.models.utils.UUIDT", return_value="0178495e-8521-0000-8e1c-2652fa57099b")
     mocker.patch("time.time", return_value=0)
 
@@ -106,8 +111,8 @@ def test_compression_and_chunking(raw_snapshot_events, mocker: MockerFixture):
                     "chunk_index": 0,
                     "chunk_count": 1,
                     "data": "H4sIAAAAAAAC/2WMywpAUABEz6fori28k1+RhQVlIYoN8uuY+9hpaprONPM+LReGnYOVQakhIiOWWzoxi25KvdIa+pSSgoqcRKqde91u+X/Mw+PIInlmONXbZ6Ndxwc14H+ijAAAAA==",
-                    "compression": "gzip-base64",
-                    "data": "H4sIAAAAAAAC//v/L5qhmkGJoYShkqGAIRXIsmJQYDBi0AGSINFMhlygaDGQlQhkFUDlDRlMGUwYzBiMGQyA0AJMQmAtWCemicYUmBjLAAABQ+l7pgAAAA==",
+                    "compression": "gzip-base64-utf8",
+                    "data": "H4sIAAAAAAAE/4uuViqpLEhVsjLSUSrJzE0tLknMLVCyMjQ1MTM2MLAwAIFaHZgiYzyKYgEFfcILSwAAAA==",
                     "has_full_snapshot": True,
                     "events_summary": [
                         {"timestamp": MILLISECOND_TIMESTAMP, "type": 2, "data": {}},
@@ -120,19 +125,110 @@ def test_compression_and_chunking(raw_snapshot_events, mocker: MockerFixture):
     ]
 
 
-def test_decompression_results_in_same_data(raw_snapshot_events):
+def test_compression_defaults_to_utf16_chunks(raw_snapshot_events):
+    compressed = list(compress_and_chunk_snapshots(raw_snapshot_events))
+    assert compressed[0]["properties"]["$snapshot_data"]["compression"] == "gzip-base64"
+
+
+@pytest.mark.parametrize("utf8_compression_enabled,expected_chunk_count", [(False, 3), (True, 2)])
+def test_decompression_results_in_same_data(
+    raw_snapshot_events, settings, utf8_compression_enabled, expected_chunk_count
+):
+    settings.SESSION_RECORDING_UTF8_COMPRESSION_ENABLED = utf8_compression_enabled
+
     assert len(list(compress_and_chunk_snapshots(raw_snapshot_events, 1000))) == 1
     assert compress_decompress_and_extract(raw_snapshot_events, 1000) == [
         raw_snapshot_events[0]["properties"]["$snapshot_data"],
         raw_snapshot_events[1]["properties"]["$snapshot_data"],
     ]
-    assert len(list(compress_and_chunk_snapshots(raw_snapshot_events, 100))) == 2
-    assert compress_decompress_and_extract(raw_snapshot_events, 100) == [
+    assert len(list(compress_and_chunk_snapshots(raw_snapshot_events, 50))) == expected_chunk_count
+    assert compress_decompress_and_extract(raw_snapshot_events, 50) == [
         raw_snapshot_events[0]["properties"]["$snapshot_data"],
         raw_snapshot_events[1]["properties"]["$snapshot_data"],
     ]
 
 
+def test_decompress_out_of_order_chunks(raw_snapshot_events):
+    snapshot_list = [
+        SnapshotDataTaggedWithWindowId(window_id="1", snapshot_data=event["properties"]["$snapshot_data"])
+        for event in compress_and_chunk_snapshots(raw_snapshot_events, 20)
+    ]
+    assert len(snapshot_list) > 2
+    snapshot_list.reverse()
+
+    assert decompress_chunked_snapshot_data(1, "someid", snapshot_list)["snapshot_data_by_window_id"]["1"] == [
+        event["properties"]["$snapshot_data"] for event in raw_snapshot_events
+    ]
+
+
+def test_decompress_interleaved_chunks(raw_snapshot_events):
+    first_chunks = [
+        SnapshotDataTaggedWithWindowId(window_id="1", snapshot_data=event["properties"]["$snapshot_data"])
+        for event in compress_and_chunk_snapshots(raw_snapshot_events[:1], 20)
+    ]
+    second_chunks = [
+        SnapshotDataTaggedWithWindowId(window_id="1", snapshot_data=event["properties"]["$snapshot_data"])
+        for event in compress_and_chunk_snapshots(raw_snapshot_events[1:], 20)
+    ]
+    snapshot_list = [first_chunks[0], *second_chunks, *first_chunks[1:]]
+
+    assert decompress_chunked_snapshot_data(1, "someid", snapshot_list)["snapshot_data_by_window_id"]["1"] == [
+        event["properties"]["$snapshot_data"] for event in raw_snapshot_events
+    ]
+
+
+def test_decompress_legacy_utf16_chunks(raw_snapshot_events):
+    raw_snapshot_data = [event["properties"]["$snapshot_data"] for event in raw_snapshot_events]
+    legacy_data = base64.b64encode(
+        gzip.compress(json.dumps(raw_snapshot_data).encode("utf-16", "surrogatepass"))
+    ).decode("utf-8")
+    snapshot_list = [
+        SnapshotDataTaggedWithWindowId(
+            window_id="1",
+            snapshot_data={
+                "chunk_id": "legacy",
+                "chunk_index": 0,
+                "chunk_count": 1,
+                "data": legacy_data,
+                "compression": "gzip-base64",
+                "has_full_snapshot": True,
+            },
+        )
+    ]
+
+    assert decompress_chunked_snapshot_data(1, "someid", snapshot_list)["snapshot_data_by_window_id"]["1"] == (
+        raw_snapshot_data
+    )
+
+
+def test_decompress_raises_on_truncated_data(raw_snapshot_events):
+    compressed = gzip.compress(json.dumps(raw_snapshot_events).encode("utf-8"))
+    # Drop the gzip trailer so the stream ends before the end-of-stream marker
+    truncated_data = base64.b64encode(compressed[:-8]).decode("utf-8")
+
+    with pytest.raises(EOFError):
+        decompress([truncated_data[:10], truncated_data[10:]])
+
+
+def test_decompression_round_trips_lone_surrogates(raw_snapshot_events):
+    raw_snapshot_events[1]["properties"]["$snapshot_data"]["data"] = {"text": "broken \ud800 emoji"}
+
+    assert compress_decompress_and_extract(raw_snapshot_events, 1000) == [
+        raw_snapshot_events[0]["properties"]["$snapshot_data"],
+        raw_snapshot_events[1]["properties"]["$snapshot_data"],
+    ]
+
+
+def test_decompression_writes_non_finite_numbers_as_null(raw_snapshot_events):
+    raw_snapshot_events[1]["properties"]["$snapshot_data"]["data"] = {
+        "x": float("nan"),
+        "y": float("inf"),
+        "z": float("-inf"),
+    }
+
+    assert compress_decompress_and_extract(raw_snapshot_events, 1000)[1]["data"] == {"x": None, "y": None, "z": None}
+
+
 def test_has_full_snapshot_property(raw_snapshot_events):
     compressed = list(compress_and_chunk_snapshots(raw_snapshot_events))
     assert len(compressed) == 1
@@ -161,6 +257,24 @@ def test_decompress_uncompressed_events_returns_unmodified_events(raw_snapshot_e
     )
 
 
+def test_decompress_uncompressed_events_returning_only_activity_info(raw_snapshot_events):
+    snapshot_data_tagged_with_window_id = [
+        SnapshotDataTaggedWithWindowId(snapshot_data=event["properties"]["$snapshot_data"], window_id="1")
+        for event in raw_snapshot_events
+    ]
+    # Malformed events without a timestamp are left out
+    snapshot_data_tagged_with_window_id.append(
+        SnapshotDataTaggedWithWindowId(snapshot_data={"type": 3, "data": {"source": 2}}, window_id="1")
+    )
+
+    assert decompress_chunked_snapshot_data(
+        1, "someid", snapshot_data_tagged_with_window_id, return_only_activity_data=True
+    )["snapshot_data_by_window_id"]["1"] == [
+        {"timestamp": MILLISECOND_TIMESTAMP, "type": 2, "data": {}},
+        {"timestamp": MILLISECOND_TIMESTAMP, "type": 3, "data": {}},
+    ]
+
+
 def test_decompress_ignores_if_not_enough_chunks(raw_snapshot_events):
     raw_snapshot_data = [event["properties"]["$snapshot_data"] for event in raw_snapshot_events]
     snapshot_data_list = [
@@ -434,6 +548,7 @@ def test_paginate_list():
     assert paginate_list(list, 5, 0) == PaginatedList(has_next=True, paginated_list=list[:5])
     assert paginate_list(list, 20, 0) == PaginatedList(has_next=False, paginated_list=list)
     assert paginate_list(list, None, 0) == PaginatedList(has_next=False, paginated_list=list)
+    assert paginate_list(list, None, 0).paginated_list is list
     assert paginate_list(list, None, 5) == PaginatedList(has_next=False, paginated_list=list[5:])
     assert paginate_list(list, 5, 5) == PaginatedList(has_next=False, paginated_list=list[5:10])
     assert paginate_list(list, 4, 5) == PaginatedList(has_next=True, paginated_list=list[5:9])
@@ -501,6 +616,30 @@ def test_get_events_summary_from_snapshot_data():
     ]
 
 
+def test_get_events_summary_from_snapshot_data_excludes_booleans():
+    snapshot_events = [
+        {"type": 3, "timestamp": MILLISECOND_TIMESTAMP, "data": {"source": True, "payload": {"level": False}}},
+    ]
+
+    events_summary = get_events_summary_from_snapshot_data(snapshot_events)
+    assert events_summary == [{"timestamp": MILLISECOND_TIMESTAMP, "type": 3, "data": {"payload": {}}}]
+    assert is_active_event(events_summary[0]) is False
+
+
+def test_get_events_summary_from_snapshot_data_sorts_by_timestamp():
+    snapshot_events = [
+        {"type": 3, "timestamp": MILLISECOND_TIMESTAMP + 2000},
+        {"type": 3, "timestamp": MILLISECOND_TIMESTAMP},
+        {"type": 3, "timestamp": MILLISECOND_TIMESTAMP + 1000},
+    ]
+
+    assert [event["timestamp"] for event in get_events_summary_from_snapshot_data(snapshot_events)] == [
+        MILLISECOND_TIMESTAMP,
+        MILLISECOND_TIMESTAMP + 1000,
+        MILLISECOND_TIMESTAMP + 2000,
+    ]
+
+
 @pytest.fixture
 def raw_snapshot_events():
     return [
@@ -1,6 +1,6 @@
 import os
 
-from posthog.settings.utils import get_from_env, get_list
+from posthog.settings.utils import get_from_env, get_list, str_to_bool
 
 INGESTION_LAG_METRIC_TEAM_IDS = get_list(os.getenv("INGESTION_LAG_METRIC_TEAM_IDS", ""))
 
@@ -15,5 +15,11 @@ EVENT_PARTITION_KEYS_TO_OVERRIDE = get_list(os.getenv("EVENT_PARTITION_KEYS_TO_O
 
 LIGHTWEIGHT_CAPTURE_ENDPOINT_ENABLED_TOKENS = get_list(os.getenv("LIGHTWEIGHT_CAPTURE_ENDPOINT_ENABLED_TOKENS", ""))
 
+# Write session recording chunks as UTF-8 ("gzip-base64-utf8") instead of UTF-16 ("gzip-base64").
+# Only enable once every web pod runs a version that can read the UTF-8 format, older ones decode all chunks as UTF-16
+SESSION_RECORDING_UTF8_COMPRESSION_ENABLED = get_from_env(
+    "SESSION_RECORDING_UTF8_COMPRESSION_ENABLED", False, type_cast=str_to_bool
+)
+
 # Keep in sync with plugin-server
 EVENTS_DEAD_LETTER_QUEUE_STATSD_METRIC = "events_added_to_dead_letter_queue"